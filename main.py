@@ -1,12 +1,201 @@
+import functools
+import hashlib
+import json
+import pickle
 import re
+import sys
+import threading
+import time
 import warnings
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import MappingProxyType, SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import unquote
+import httpx
+import requests.models
 from dateutil import parser
 from configparser import ConfigParser
 from notion_client import Client
+from notion_client.errors import HTTPResponseError
 from pyzotero import zotero
 from tqdm import tqdm
 import textwrap
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NOTION_MAX_WORKERS = 8
+# Building payloads in worker processes only pays off once it outweighs the cost of starting the processes.
+PROCESS_POOL_MIN_RECORDS = 256
+NOTION_MAX_CONNECTIONS = 32
+NOTION_MAX_RETRIES = 5
+NOTION_RETRY_STATUSES = (429, 502, 503, 504)
+SYNC_STATE_PATH = "./.sync_state.json"
+RECORD_CACHE_PATH = Path("~/.zotero2notion/cache.pkl").expanduser()
+RECORD_CACHE_SCHEMA = 1
+PAYLOAD_CACHE_PATH = Path("~/.zotero2notion/payloads.pkl").expanduser()
+PAYLOAD_CACHE_SCHEMA = 1
+
+# Optional property holding a digest of the synced payload, so that records whose payload did not change are skipped.
+PAYLOAD_HASH_PROPERTY = "Zotero: Payload Hash"
+
+# Properties needed to match Notion records to Zotero records. Queries only return these to keep responses small.
+NOTION_INDEX_PROPERTIES = ("Zotero: Key", "Zotero: Version", PAYLOAD_HASH_PROPERTY)
+
+# Properties that change with every Zotero version, which are left out of the payload hash.
+_UNHASHED_PROPERTIES = frozenset({"Zotero: Version", "Zotero: Date Modified"})
+
+_CITEKEY_RE = re.compile(r"Citation Key:[ \t]+(\S+)")
+# Notion icons of Zotero item types.
+TYPE_EMOJI = {
+    "journalArticle": "📄",
+    "patent": "💡",
+    "book": "📘",
+    "bookSection": "📖",
+    "conferencePaper": "🧑‍🏫",
+    "thesis": "🎓",
+    "presentation": "💬",
+    "webPage": "🌐",
+}
+
+# Tags that ZotFile adds to track files sent to a tablet.
+_AUTO_TAGS = frozenset({"_tablet", "_tablet_modified"})
+
+_DATE_RE = re.compile(r"(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?")
+
+
+class RateLimiter:
+    """Block callers so that no more than a given number of calls start within a sliding time window.
+
+    Args:
+        max_calls: Maximum number of calls allowed per period.
+        period: Length of the sliding window in seconds.
+    """
+
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return self
+                time.sleep(self.period - (now - self._calls[0]))
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+# Notion allows an average of three requests per second per integration.
+notion_rate_limiter = RateLimiter(3, 1.0)
+
+
+def call_notion(func, *args, retry_statuses=NOTION_RETRY_STATUSES, **kwargs):
+    """Call a Notion API endpoint under the shared rate limit, retrying rate-limited and transient server errors.
+
+    Retries back off exponentially, or wait as long as Notion asks through the Retry-After header if that is longer.
+
+    Args:
+        func: Notion client method to call, e.g. notion_client.pages.update.
+        *args: Positional arguments for func.
+        retry_statuses: HTTP statuses that are retried. Calls that are not idempotent should only retry 429, as Notion
+            may have processed a request that failed with a server error.
+        **kwargs: Keyword arguments for func.
+    """
+    for attempt in range(NOTION_MAX_RETRIES + 1):
+        try:
+            with notion_rate_limiter:
+                return func(*args, **kwargs)
+        except HTTPResponseError as e:
+            if e.status not in retry_statuses or attempt == NOTION_MAX_RETRIES:
+                raise
+            delay = 0.5 * 2**attempt
+            try:
+                delay = max(delay, float(e.headers["Retry-After"]))
+            except (AttributeError, KeyError, ValueError):
+                pass
+            time.sleep(delay)
+
+
+def is_missing_page_error(error):
+    """Check whether a Notion API error means that the page no longer exists, or was archived.
+
+    Args:
+        error: Error raised by the Notion client.
+    """
+    return error.status == 404 or (
+        error.status == 400 and "archived" in str(error).lower()
+    )
+
+
+# Property IDs of Notion databases, mapped by database ID.
+_notion_property_ids = {}
+
+
+def use_fast_json():
+    """Parse Notion and Zotero API responses with orjson, if it is installed.
+
+    notion-client and pyzotero parse responses through httpx and requests, which both call the json module through a
+    module-level reference. That reference is replaced by one that parses with orjson but still serializes with json.
+    """
+    if orjson is None:
+        return
+    fast_json = SimpleNamespace(loads=orjson.loads, dumps=json.dumps)
+    httpx._models.jsonlib = fast_json
+    requests.models.complexjson = fast_json
+
+
+# Multi-select options shared by all records, mapped by option name.
+_MS_CACHE = {}
+
+
+def _ms(name):
+    """Return a shared multi-select option for a name.
+
+    Authors, tags and collections recur across many records, so their options are reused instead of building a new
+    dictionary and string per record.
+
+    Args:
+        name: Name of the option.
+    """
+    name = sys.intern(name)
+    option = _MS_CACHE.get(name)
+    return option if option is not None else _MS_CACHE.setdefault(name, {"name": name})
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date_fast(date_str):
+    """Parse a Zotero date, avoiding the slow dateutil parser for the ISO 8601 dates that Zotero mostly stores.
+
+    Dates with a missing month or day are placed on the first month or day.
+
+    Args:
+        date_str: Date string from a Zotero record.
+    """
+    try:
+        return datetime.fromisoformat(date_str)
+    except ValueError:
+        pass
+    match = _DATE_RE.fullmatch(date_str)
+    if match:
+        year, month, day = match.groups()
+        try:
+            return datetime(int(year), int(month or 1), int(day or 1))
+        except ValueError:
+            pass
+    return parser.parse(date_str, default=datetime(1900, 1, 1))
+
 
 def create_post_objects(record, zotero_collections):
     """Create objects for Notion POST message, which will create a Notion record based on the given Zotero record.
@@ -16,24 +205,12 @@ def create_post_objects(record, zotero_collections):
     """
     record_data = record["data"]  # Record data from Zotero record.
 
-    properties = {}
-    children = []
-
-    type_emoji = {
-        "journalArticle": "📄",
-        "patent": "💡",
-        "book": "📘",
-        "bookSection": "📖",
-        "conferencePaper": "🧑‍🏫",
-        "thesis": "🎓",
-        "presentation": "💬",
-        "webPage": "🌐",
-    }
-
+    # All properties are computed first, so the properties dictionary can be built in one go.
+    citation_key = None
     try:
-        citekey_matches = re.search(r"Citation Key: (\S*)", record_data["extra"])
-        properties["Citation Key"] = {
-            "title": [{"text": {"content": citekey_matches.group(1)}}]
+        citekey_matches = _CITEKEY_RE.search(record_data["extra"])
+        citation_key = {
+            "title": [{"text": {"content": sys.intern(citekey_matches.group(1))}}]
         }
     except (AttributeError, KeyError) as e:
         warnings.warn(
@@ -41,39 +218,35 @@ def create_post_objects(record, zotero_collections):
         )
         pass
 
-    properties["Title"] = {
-        "rich_text": [{"type": "text", "text": {"content": record_data["title"]}}]
-    }
-
+    publication_date = None
     if "date" in record_data and record_data["date"]:
-        properties["Publication Date"] = {
-            "date": {"start": parser.parse(record_data["date"]).isoformat()}
+        publication_date = {
+            "date": {"start": _parse_date_fast(record_data["date"]).isoformat()}
         }
 
-    authors = []
+    authors = None
     if "creators" in record_data:
-        for creator in record_data["creators"]:
-            if creator["creatorType"] == "author":
-                author_str = ""
-                for key in ["name", "firstName", "middleName", "lastName"]:
-                    if key in creator:
-                        author_str += creator[key]
-                        author_str += " " if key != "lastName" else ""
-                authors += [{"name": author_str}]
-        properties["Authors"] = {
+        authors = {
             "type": "multi_select",
-            "multi_select": authors,
+            "multi_select": [
+                _ms(
+                    " ".join(
+                        creator[key]
+                        for key in ("name", "firstName", "middleName", "lastName")
+                        if creator.get(key)
+                    )
+                )
+                for creator in record_data["creators"]
+                if creator["creatorType"] == "author"
+            ],
         }
 
-    tags = []
-    for tag in record_data["tags"]:
-        # It seems like manual tags do not have a type. We filter out automatic tags.
-        if "type" not in tag:
-            tags += [{"name": tag["tag"]}]
-    properties["Tags"] = {
-        "type": "multi_select",
-        "multi_select": tags,
-    }
+    # It seems like manual tags do not have a type. We filter out automatic tags.
+    tags = [
+        _ms(tag["tag"])
+        for tag in record_data["tags"]
+        if "type" not in tag and tag["tag"] not in _AUTO_TAGS
+    ]
 
     collections = []
     for collection_key in record_data["collections"]:
@@ -81,28 +254,41 @@ def create_post_objects(record, zotero_collections):
             filter(lambda person: person["key"] == collection_key, zotero_collections)
         )
         if len(collection_search_result):
-            collections += [{"name": collection_search_result[0]["data"]["name"]}]
+            collections.append(_ms(collection_search_result[0]["data"]["name"]))
 
-    properties["Collections"] = {
-        "type": "multi_select",
-        "multi_select": collections,
-    }
+    url = None
+    if "url" in record_data and record_data["url"]:
+        url = {"url": record_data.get("url")}
 
-    properties["Zotero: Key"] = {
-        "rich_text": [{"type": "text", "text": {"content": record_data["key"]}}]
-    }
-    properties["Zotero: Version"] = {"number": record_data["version"]}
-    properties["Zotero: Date Modified"] = {
-        "date": {"start": record_data["dateModified"]}
+    properties = {
+        **({"Citation Key": citation_key} if citation_key else {}),
+        "Title": {
+            "rich_text": [{"type": "text", "text": {"content": record_data["title"]}}]
+        },
+        **({"Publication Date": publication_date} if publication_date else {}),
+        **({"Authors": authors} if authors else {}),
+        "Tags": {
+            "type": "multi_select",
+            "multi_select": tags,
+        },
+        "Collections": {
+            "type": "multi_select",
+            "multi_select": collections,
+        },
+        "Zotero: Key": {
+            "rich_text": [
+                {"type": "text", "text": {"content": sys.intern(record_data["key"])}}
+            ]
+        },
+        "Zotero: Version": {"number": record_data["version"]},
+        "Zotero: Date Modified": {"date": {"start": record_data["dateModified"]}},
+        "Zotero: Date Added": {"date": {"start": record_data["dateAdded"]}},
+        "Zotero: Link": {"url": record["links"]["alternate"]["href"]},
+        **({"URL": url} if url else {}),
     }
-    properties["Zotero: Date Added"] = {"date": {"start": record_data["dateAdded"]}}
-    properties["Zotero: Link"] = {"url": record["links"]["alternate"]["href"]}
-
-    if "url" in record_data and record_data["url"]:
-        properties["URL"] = {"url": record_data.get("url")}
 
-    if "abstractNote" in record_data:
-        children.append(
+    children = (
+        [
             {
                 "object": "block",
                 "type": "heading_2",
@@ -114,10 +300,7 @@ def create_post_objects(record, zotero_collections):
                         }
                     ]
                 },
-            }
-        )
-
-        children.append(
+            },
             {
                 "object": "block",
                 "type": "paragraph",
@@ -140,31 +323,83 @@ def create_post_objects(record, zotero_collections):
                         }
                     ]
                 },
-            }
-        )
+            },
+        ]
+        if "abstractNote" in record_data
+        else []
+    )
 
-    return properties, children, type_emoji.get(record_data["itemType"], "📝")
+    return properties, children, TYPE_EMOJI.get(record_data["itemType"], "📝")
+
+
+def build_payloads(records, zotero_collections):
+    """Create the Notion payloads of Zotero records, see create_post_objects.
+
+    Large batches are built in a process pool, so payload construction uses all cores.
+
+    Args:
+        records: A list of dictionaries containing Zotero records.
+        zotero_collections: A list of dictionaries containing Zotero collections.
+    """
+    build = functools.partial(
+        create_post_objects, zotero_collections=zotero_collections
+    )
+    if len(records) < PROCESS_POOL_MIN_RECORDS:
+        return [build(record) for record in records]
+    with ProcessPoolExecutor() as pool:
+        return list(pool.map(build, records, chunksize=32))
 
 
 def get_existing_notion_records(notion_records):
     """Extract the Zotero version numbers of Notion records and return them.
 
     Args:
-        zotero_records: A list of dictionaries containing Zotero records.
-        notion_records: A list of dictionaries containing Notion records.
+        notion_records: An iterable of dictionaries containing Notion records.
     """
     existing_records = {}
     for record in notion_records:
+        payload_hash = (
+            record["properties"].get(PAYLOAD_HASH_PROPERTY, {}).get("rich_text")
+        )
         existing_records[
             record["properties"]["Zotero: Key"]["rich_text"][0]["plain_text"]
         ] = {
             "page_id": record["id"],
             "version": record["properties"]["Zotero: Version"]["number"],
+            "payload_hash": payload_hash[0]["plain_text"] if payload_hash else None,
         }
     return existing_records
 
 
-def find_removed_records(notion_client, zotero_records, existing_records):
+def get_payload_hash(properties, emoji):
+    """Return a digest of the Notion payload of a record, which changes whenever a synced field changes.
+
+    Args:
+        properties: Notion properties of the record, without the payload hash itself.
+        emoji: Icon of the record.
+    """
+    payload = {
+        "properties": {
+            name: value
+            for name, value in properties.items()
+            if name not in _UNHASHED_PROPERTIES
+        },
+        "icon": emoji,
+    }
+    # The serialization must not depend on which JSON library is installed, or every stored hash would change.
+    serialized = json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+    return hashlib.blake2b(serialized, digest_size=8).hexdigest()
+
+
+def find_removed_records(
+    notion_client,
+    zotero_records,
+    existing_records,
+    deleted_keys=None,
+    track_payload_hash=False,
+):
     """Find records that no longer exist in Zotero but do exist in Notion.
 
     This function checks if records were deleted from Zotero but still exists in Notion. We mark any Notion records that
@@ -172,133 +407,718 @@ def find_removed_records(notion_client, zotero_records, existing_records):
     Therefore, the user should first update any links to the Notion entry before it can be safely deleted.
 
     Args:
-        zotero_records: A list of dictionaries containing Zotero records
-        notion_records: A list of dictionaries containing Notion records
+        notion_client: Notion client object.
+        zotero_records: An iterable of dictionaries containing Zotero records
+        existing_records: A dictionary of Notion records, mapped by Zotero key, see get_existing_notion_records.
+        deleted_keys: Zotero keys reported as deleted since the last sync. If None, every Notion record that has no
+            counterpart in zotero_records is considered deleted.
+        track_payload_hash: Whether the Notion database has a property to store the payload hash in. If so, the hash of
+            marked records is cleared, so that they are updated again if they are restored in Zotero.
     """
-    keys_in_zotero = set([record["key"] for record in zotero_records])
-    deleted_records = []
-    for key, record in tqdm(
-        existing_records.items(),
-        desc="Checking for deleted Zotero records that exist in Notion",
-        unit="record",
-    ):
-        if key not in keys_in_zotero:
-            deleted_records.append(key)
-            notion_client.pages.update(
-                record["page_id"],
-                properties={
-                    "Tags": {
-                        "type": "multi_select",
-                        "multi_select": [{"name": "Deleted from Zotero"}],
-                    },
-                },
+    if deleted_keys is None:
+        keys_in_zotero = {record["key"] for record in zotero_records}
+        deleted_records = sorted(existing_records.keys() - keys_in_zotero)
+    else:
+        deleted_records = sorted(existing_records.keys() & set(deleted_keys))
+
+    def _mark_deleted(key):
+        """Mark the Notion record of a deleted Zotero record, and report whether the Notion record still exists."""
+        properties = {
+            "Tags": {
+                "type": "multi_select",
+                "multi_select": [{"name": "Deleted from Zotero"}],
+            },
+        }
+        if track_payload_hash:
+            properties[PAYLOAD_HASH_PROPERTY] = {"rich_text": []}
+        try:
+            call_notion(
+                notion_client.pages.update,
+                existing_records[key]["page_id"],
+                properties=properties,
                 icon={"type": "emoji", "emoji": "❌"},
             )
+        except HTTPResponseError as e:
+            if not is_missing_page_error(e):
+                raise
+            return False
+        existing_records[key]["payload_hash"] = None
+        return True
+
+    with ThreadPoolExecutor(max_workers=NOTION_MAX_WORKERS) as executor:
+        marked = list(
+            tqdm(
+                executor.map(_mark_deleted, deleted_records),
+                total=len(deleted_records),
+                mininterval=0.5,
+                miniters=max(1, len(deleted_records) // 200),
+                desc="Checking for deleted Zotero records that exist in Notion",
+                unit="record",
+            )
+        )
+    # Records whose Notion page is already gone need no manual action.
+    for key, exists in zip(deleted_records, marked):
+        if not exists:
+            del existing_records[key]
+    deleted_records = [key for key, exists in zip(deleted_records, marked) if exists]
     if deleted_records:
         print(
             f"Records to be manually deleted from Notion: {', '.join(deleted_records)} (marked by icon ❌ and tagged \"Deleted from Zotero\")"
         )
 
 
-def get_notion_records(notion_client, notion_token, notion_db_id):
-    """Retrieve Notion records through Notion API.
+def get_notion_property_ids(notion_client, notion_db_id):
+    """Retrieve the IDs of the properties of a Notion database, mapped by property name.
+
+    The IDs are requested once per database and cached for the rest of the run.
 
     Args:
         notion_client: Notion client object.
-        notion_token: Notion API token.
         notion_db_id: Notion database ID.
     """
-    notion_response = notion_client.databases.query(
-        **{"database_id": str(notion_db_id)}
+    if notion_db_id not in _notion_property_ids:
+        database = call_notion(
+            notion_client.databases.retrieve, database_id=notion_db_id
+        )
+        # Notion returns URL-encoded IDs, which are encoded again when they are sent as query parameters.
+        _notion_property_ids[notion_db_id] = {
+            name: unquote(prop["id"]) for name, prop in database["properties"].items()
+        }
+    return _notion_property_ids[notion_db_id]
+
+
+def _query_notion_page(notion_client, notion_db_id, filter_properties=None, **kwargs):
+    """Retrieve a single page of results of a Notion database query.
+
+    Args:
+        notion_client: Notion client object.
+        notion_db_id: Notion database ID.
+        filter_properties: Names of the properties to include in the results. If None, all properties are included.
+            Names of properties that do not exist in the database are ignored.
+        **kwargs: Query parameters, such as a filter or a start cursor.
+    """
+    query = None
+    if filter_properties is not None:
+        property_ids = get_notion_property_ids(notion_client, notion_db_id)
+        query = {
+            "filter_properties": [
+                property_ids[name] for name in filter_properties if name in property_ids
+            ]
+        }
+    return call_notion(
+        notion_client.request,
+        path=f"databases/{notion_db_id}/query",
+        method="POST",
+        query=query,
+        body=kwargs,
+    )
+
+
+def query_notion_database(
+    notion_client, notion_db_id, filter_properties=None, **kwargs
+):
+    """Yield the records of a Notion database query, following pagination.
+
+    Pages of results are requested as the records are consumed, so only one page is held in memory at a time.
+
+    Args:
+        notion_client: Notion client object.
+        notion_db_id: Notion database ID.
+        filter_properties: Names of the properties to include in the results. If None, all properties are included.
+        **kwargs: Additional query parameters, such as a filter.
+    """
+    kwargs = {"page_size": 100, **kwargs}
+    notion_response = _query_notion_page(
+        notion_client, notion_db_id, filter_properties, **kwargs
     )
-    notion_records = notion_response["results"]
+    yield from notion_response["results"]
     while notion_response["has_more"]:
-        notion_response = notion_client.databases.query(
-            **{
-                "database_id": notion_db_id,
-                "start_cursor": notion_response["next_cursor"],
+        notion_response = _query_notion_page(
+            notion_client,
+            notion_db_id,
+            filter_properties,
+            start_cursor=notion_response["next_cursor"],
+            **kwargs,
+        )
+        yield from notion_response["results"]
+
+
+def _parse_notion_date(date_str):
+    """Parse the start of a Notion date property. Dates without a time zone are taken as UTC.
+
+    Args:
+        date_str: ISO 8601 date or date-time string.
+    """
+    date = parser.isoparse(date_str)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def query_notion_database_sharded(
+    notion_client, notion_db_id, filter_properties=None, shards=NOTION_MAX_WORKERS
+):
+    """Yield all records of a Notion database, paginating through ranges of "Zotero: Date Added" concurrently.
+
+    Pagination cursors are opaque, so a single query can only be paginated sequentially. Instead, the first page of
+    records is retrieved in order of date added, and the range between its last date and the latest date added is split
+    into equally long shards that are each paginated by their own worker. Each shard is collected by its worker and
+    yielded as soon as all shards before it are complete.
+
+    Args:
+        notion_client: Notion client object.
+        notion_db_id: Notion database ID.
+        filter_properties: Names of the properties to include in the results. If None, all properties are included.
+        shards: Number of date ranges to query concurrently.
+    """
+    if filter_properties is not None:
+        filter_properties = (*filter_properties, "Zotero: Date Added")
+
+    def _date_added(record):
+        return _parse_notion_date(
+            record["properties"]["Zotero: Date Added"]["date"]["start"]
+        )
+
+    notion_response = _query_notion_page(
+        notion_client,
+        notion_db_id,
+        filter_properties,
+        page_size=100,
+        filter={"property": "Zotero: Date Added", "date": {"is_not_empty": True}},
+        sorts=[{"property": "Zotero: Date Added", "direction": "ascending"}],
+    )
+    # Shards may overlap with the first page and with each other, so records are only yielded once.
+    seen_ids = set()
+    for record in notion_response["results"]:
+        seen_ids.add(record["id"])
+        yield record
+
+    # Records without a date added do not fall in any range, so they get a shard of their own.
+    shard_filters = [{"property": "Zotero: Date Added", "date": {"is_empty": True}}]
+    if notion_response["has_more"]:
+        earliest = _date_added(notion_response["results"][-1])
+        latest_response = _query_notion_page(
+            notion_client,
+            notion_db_id,
+            ("Zotero: Date Added",),
+            page_size=1,
+            filter={"property": "Zotero: Date Added", "date": {"is_not_empty": True}},
+            sorts=[{"property": "Zotero: Date Added", "direction": "descending"}],
+        )
+        latest = max(earliest, _date_added(latest_response["results"][0]))
+        step = (latest - earliest) / shards
+        starts = [(earliest + i * step).isoformat() for i in range(shards)]
+        for start, end in zip(starts, starts[1:] + [None]):
+            shard_filter = {
+                "property": "Zotero: Date Added",
+                "date": {"on_or_after": start},
             }
+            if end is not None:
+                shard_filter = {
+                    "and": [
+                        shard_filter,
+                        {"property": "Zotero: Date Added", "date": {"before": end}},
+                    ]
+                }
+            shard_filters.append(shard_filter)
+
+    with ThreadPoolExecutor(max_workers=len(shard_filters)) as executor:
+        shard_records = executor.map(
+            lambda shard_filter: list(
+                query_notion_database(
+                    notion_client,
+                    notion_db_id,
+                    filter_properties=filter_properties,
+                    filter=shard_filter,
+                )
+            ),
+            shard_filters,
         )
-        notion_records += notion_response["results"]
-    print(f"Retrieved {len(notion_records)} Notion records")
-    return notion_records
+        for records in shard_records:
+            for record in records:
+                if record["id"] not in seen_ids:
+                    seen_ids.add(record["id"])
+                    yield record
 
 
-def get_zotero_records(zot):
+def iter_notion_records(
+    notion_client, notion_token, notion_db_id, zotero_keys=None, edited_since=None
+):
+    """Yield Notion records retrieved through Notion API.
+
+    Args:
+        notion_client: Notion client object.
+        notion_token: Notion API token.
+        notion_db_id: Notion database ID.
+        zotero_keys: Zotero keys of the records to retrieve. If None, all records in the database are retrieved.
+        edited_since: ISO 8601 timestamp. If given, only records edited in Notion on or after it are retrieved.
+    """
+    if zotero_keys is None:
+        if edited_since is None:
+            yield from query_notion_database_sharded(
+                notion_client, notion_db_id, filter_properties=NOTION_INDEX_PROPERTIES
+            )
+        else:
+            yield from query_notion_database(
+                notion_client,
+                notion_db_id,
+                filter_properties=NOTION_INDEX_PROPERTIES,
+                filter={
+                    "timestamp": "last_edited_time",
+                    "last_edited_time": {"on_or_after": edited_since},
+                },
+            )
+    else:
+        # Notion limits the number of conditions in a compound filter, so we look the keys up in batches.
+        zotero_keys = list(zotero_keys)
+        for i in range(0, len(zotero_keys), 100):
+            yield from query_notion_database(
+                notion_client,
+                notion_db_id,
+                filter_properties=NOTION_INDEX_PROPERTIES,
+                filter={
+                    "or": [
+                        {"property": "Zotero: Key", "rich_text": {"equals": key}}
+                        for key in zotero_keys[i : i + 100]
+                    ]
+                },
+            )
+
+
+def get_zotero_records(zot, since=None):
     """Retrieve Zotero records through Zotero API.
 
     Args:
-        zotero_library_id: Zotero library ID
-        zotero_library_type: Zotero library type (typically "user")
-        zotero_api_key: Zotero API key
+        zot: Zotero client object.
+        since: Zotero library version of the last sync. If given, only records modified after it are retrieved.
+
+    Returns:
+        The retrieved records and the current Zotero library version.
     """
-    zotero_client.add_parameters(sort="dateAdded", direction="desc")
-    zotero_records = zotero_client.everything(zot.top())
+    parameters = {"sort": "dateAdded", "direction": "desc"}
+    if since is not None:
+        parameters["since"] = since
+    zot.add_parameters(**parameters)
+    zotero_records = zot.everything(zot.top())
     print(f"Retrieved {len(zotero_records)} Zotero records")
-    return zotero_records
+    try:
+        library_version = int(zot.request.headers["Last-Modified-Version"])
+    except (AttributeError, KeyError):
+        library_version = max(
+            (record["version"] for record in zotero_records), default=since
+        )
+    return zotero_records, library_version
+
+
+def load_sync_state(path=SYNC_STATE_PATH):
+    """Load the state saved by the last successful sync, or an empty state if there is none.
+
+    Args:
+        path: Path of the sync state file.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_sync_state(sync_state, path=SYNC_STATE_PATH):
+    """Save the state of a successful sync, so the next sync only has to process records modified after it.
+
+    Args:
+        sync_state: Dictionary containing the sync state.
+        path: Path of the sync state file.
+    """
+    with open(path, "w") as f:
+        json.dump(sync_state, f)
+
+
+def _load_pickle(path):
+    """Load a pickled object, or return None if the file is missing or unreadable.
+
+    Args:
+        path: Path of the pickle file.
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+def _dump_pickle(obj, path):
+    """Pickle an object to a file, creating its directory if needed.
+
+    Args:
+        obj: Object to pickle.
+        path: Path of the pickle file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first, so an interrupted write does not leave a corrupt cache behind.
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(obj, f)
+    tmp_path.replace(path)
+
+
+def load_record_cache(notion_db_id, path=RECORD_CACHE_PATH):
+    """Load the cached Notion records of a database, or None if there is no usable cache.
+
+    Args:
+        notion_db_id: Notion database ID.
+        path: Path of the cache file.
+
+    Returns:
+        A dictionary with the cached records, mapped by Zotero key, and the time at which they were retrieved.
+    """
+    record_cache = _load_pickle(path)
+    if (
+        record_cache is None
+        or record_cache.get("schema") != RECORD_CACHE_SCHEMA
+        or record_cache.get("notion_database_id") != notion_db_id
+    ):
+        return None
+    return record_cache
+
+
+def save_record_cache(
+    existing_records, notion_db_id, synced_at, path=RECORD_CACHE_PATH
+):
+    """Cache the Notion records of a database, so the next sync does not have to retrieve all of them again.
+
+    Args:
+        existing_records: A dictionary of Notion records, mapped by Zotero key, see get_existing_notion_records.
+        notion_db_id: Notion database ID.
+        synced_at: ISO 8601 timestamp of the moment the records were retrieved.
+        path: Path of the cache file.
+    """
+    _dump_pickle(
+        {
+            "schema": RECORD_CACHE_SCHEMA,
+            "notion_database_id": notion_db_id,
+            "synced_at": synced_at,
+            "records": existing_records,
+        },
+        path,
+    )
+
+
+def load_payload_cache(path=PAYLOAD_CACHE_PATH):
+    """Load the cached Notion payloads built by previous syncs, or an empty cache if there is none.
+
+    Args:
+        path: Path of the cache file.
 
+    Returns:
+        A dictionary mapping Zotero keys to tuples of the record version, the collections signature and the payload.
+    """
+    payload_cache = _load_pickle(path)
+    if payload_cache is None or payload_cache.get("schema") != PAYLOAD_CACHE_SCHEMA:
+        return {}
+    return payload_cache["payloads"]
+
+
+def save_payload_cache(payload_cache, path=PAYLOAD_CACHE_PATH):
+    """Save the Notion payloads built by this sync, see load_payload_cache. An empty cache removes the cache file.
 
-def process_records(zotero_records, zotero_client, notion_records, notion_client):
+    Args:
+        payload_cache: Dictionary of cached payloads, mapped by Zotero key.
+        path: Path of the cache file.
+    """
+    if not payload_cache:
+        path.unlink(missing_ok=True)
+        return
+    _dump_pickle({"schema": PAYLOAD_CACHE_SCHEMA, "payloads": payload_cache}, path)
+
+
+def get_collections_signature(zotero_collections):
+    """Return a digest of the Zotero collection names, which are part of every payload.
+
+    Args:
+        zotero_collections: A list of dictionaries containing Zotero collections.
+    """
+    names = sorted((c["key"], c["data"]["name"]) for c in zotero_collections)
+    return hashlib.blake2b(json.dumps(names).encode(), digest_size=8).hexdigest()
+
+
+def process_records(
+    zotero_records,
+    zotero_client,
+    existing_records,
+    notion_client,
+    notion_db_id,
+    deleted_keys=None,
+    payload_cache=None,
+):
     """Process records by submitting new records to Notion, based on the given Zotero records.
 
     Args:
         zotero_records: A list of dictionaries containing Zotero records.
-        notion_records: A list of dictionaries containing Notion records.
+        existing_records: A dictionary of Notion records, mapped by Zotero key, see get_existing_notion_records.
         notion_client: Notion client object.
-    """
-    # Get Zotero keys of records that exist in Notion.
-    existing_records = get_existing_notion_records(notion_records)
+        notion_db_id: Notion database ID.
+        deleted_keys: Zotero keys reported as deleted since the last sync, see find_removed_records.
+        payload_cache: Dictionary of previously built payloads, see load_payload_cache. Built payloads are added to it.
 
+    Returns:
+        existing_records, updated with the Notion records that were created or updated.
+    """
     # Get Zotero collections
     zotero_collections = zotero_client.collections()
+    collections_signature = get_collections_signature(zotero_collections)
+    if payload_cache is None:
+        payload_cache = {}
 
-    for record in tqdm(
-        zotero_records,
-        desc="Updating Notion records based on Zotero records",
-        unit="record",
+    # Only records that are new or have a new version are synced. Their payloads are built up front, so the CPU work can
+    # be spread over multiple processes, reusing cached payloads of records that did not change since they were built.
+    changed_records = []
+    for record in zotero_records:
+        existing = existing_records.get(record["data"]["key"])
+        if existing is None or record["data"]["version"] != existing["version"]:
+            changed_records.append(record)
+    records_to_build = []
+    for record in changed_records:
+        cached = payload_cache.get(record["data"]["key"])
+        cache_key = (record["data"]["version"], collections_signature)
+        if cached is None or cached[:2] != cache_key:
+            records_to_build.append(record)
+    for record, payload in zip(
+        records_to_build, build_payloads(records_to_build, zotero_collections)
     ):
+        payload_cache[record["data"]["key"]] = (
+            record["data"]["version"],
+            collections_signature,
+            payload,
+        )
+
+    # The payload hash is only tracked if the database has a property to store it in.
+    track_payload_hash = PAYLOAD_HASH_PROPERTY in get_notion_property_ids(
+        notion_client, notion_db_id
+    )
+
+    def _sync_one(record):
+        """Create or update the Notion record of a single Zotero record and report which action was taken."""
         # Check if record already exists in the Notion database. If it does not, we add it. Otherwise, we update it.
-        if record["data"]["key"] not in existing_records:
-            properties, children, emoji = create_post_objects(
-                record, zotero_collections
-            )
-            notion_client.pages.create(
-                parent={"database_id": notion_db_id},
-                properties=properties,
-                children=children,
-                icon={"type": "emoji", "emoji": emoji},
-            )
-        elif (
-            record["data"]["version"]
-            != existing_records[record["data"]["key"]]["version"]
-        ):
-            properties, children, emoji = create_post_objects(
-                record, zotero_collections
-            )
-            notion_client.pages.update(
-                existing_records[record["data"]["key"]]["page_id"],
-                properties=properties,
-                icon={"type": "emoji", "emoji": emoji},
+        key, version = record["data"]["key"], record["data"]["version"]
+        existing = existing_records.get(key)
+        properties, children, emoji = payload_cache[key][2]
+        payload_hash = None
+        if track_payload_hash:
+            payload_hash = get_payload_hash(properties, emoji)
+            properties = {
+                **properties,
+                PAYLOAD_HASH_PROPERTY: {
+                    "rich_text": [{"type": "text", "text": {"content": payload_hash}}]
+                },
+            }
+
+        if existing is not None:
+            # Zotero also bumps the version for changes we do not sync, such as attachments. Skip those updates.
+            notion_record = {
+                "page_id": existing["page_id"],
+                "version": version,
+                "payload_hash": payload_hash,
+            }
+            if payload_hash is not None and payload_hash == existing.get(
+                "payload_hash"
+            ):
+                return "unchanged", key, notion_record
+            try:
+                call_notion(
+                    notion_client.pages.update,
+                    existing["page_id"],
+                    properties=properties,
+                    icon={"type": "emoji", "emoji": emoji},
+                )
+                return "updated", key, notion_record
+            except HTTPResponseError as e:
+                # The cached page may have been deleted in Notion since, in which case we add the record again.
+                if not is_missing_page_error(e):
+                    raise
+
+        # Retrying a create after a server error could create a duplicate page, so only rate limits are retried.
+        page = call_notion(
+            notion_client.pages.create,
+            retry_statuses=(429,),
+            parent={"database_id": notion_db_id},
+            properties=properties,
+            children=children,
+            icon={"type": "emoji", "emoji": emoji},
+        )
+        return (
+            "created",
+            key,
+            {
+                "page_id": page["id"],
+                "version": version,
+                "payload_hash": payload_hash,
+            },
+        )
+
+    with ThreadPoolExecutor(max_workers=NOTION_MAX_WORKERS) as executor:
+        results = list(
+            tqdm(
+                executor.map(_sync_one, changed_records),
+                total=len(changed_records),
+                mininterval=0.5,
+                miniters=max(1, len(changed_records) // 200),
+                desc="Updating Notion records based on Zotero records",
+                unit="record",
             )
+        )
+    for _, key, notion_record in results:
+        existing_records[key] = notion_record
+        # The record cache now holds the synced version, so the payload is not needed anymore.
+        payload_cache.pop(key, None)
+
+    find_removed_records(
+        notion_client,
+        zotero_records,
+        existing_records,
+        deleted_keys,
+        track_payload_hash=track_payload_hash,
+    )
+    if deleted_keys is None:
+        stale_keys = payload_cache.keys() - {
+            record["data"]["key"] for record in zotero_records
+        }
+    else:
+        stale_keys = payload_cache.keys() & set(deleted_keys)
+    for key in stale_keys:
+        del payload_cache[key]
+    return existing_records
 
-    find_removed_records(notion_client, zotero_records, existing_records)
 
+@functools.lru_cache(maxsize=None)
+def load_config(path="./config.ini"):
+    """Read the configuration file. The file is parsed only once per process, so the settings are returned read-only.
 
-if __name__ == "__main__":
+    Args:
+        path: Path of the configuration file.
+    """
     cfg = ConfigParser()
-    cfg.read("./config.ini")
-    notion_token = cfg.get("Notion", "TOKEN")
-    notion_db_id = cfg.get("Notion", "DATABASE_ID")
-    notion_client = Client(auth=notion_token)
-
-    zotero_library_id = int(cfg.get("Zotero", "LIBRARY_ID"))
-    zotero_library_type = cfg.get("Zotero", "LIBRARY_TYPE")
-    zotero_api_key = cfg.get("Zotero", "API_KEY")
+    cfg.read(path)
+    return MappingProxyType(
+        {
+            "notion_token": cfg.get("Notion", "TOKEN"),
+            "notion_db_id": cfg.get("Notion", "DATABASE_ID"),
+            "zotero_library_id": int(cfg.get("Zotero", "LIBRARY_ID")),
+            "zotero_library_type": cfg.get("Zotero", "LIBRARY_TYPE"),
+            "zotero_api_key": cfg.get("Zotero", "API_KEY"),
+        }
+    )
+
+
+def main():
+    """Sync the configured Zotero library to the configured Notion database."""
+    config = load_config()
+    notion_token = config["notion_token"]
+    notion_db_id = config["notion_db_id"]
+    use_fast_json()
+    notion_client = Client(
+        auth=notion_token,
+        client=httpx.Client(
+            transport=httpx.HTTPTransport(
+                limits=httpx.Limits(
+                    max_connections=NOTION_MAX_CONNECTIONS,
+                    max_keepalive_connections=NOTION_MAX_CONNECTIONS,
+                ),
+                retries=NOTION_MAX_RETRIES,
+            )
+        ),
+    )
+
+    zotero_library_id = config["zotero_library_id"]
+    zotero_library_type = config["zotero_library_type"]
+    zotero_api_key = config["zotero_api_key"]
     zotero_client = zotero.Zotero(
         zotero_library_id, zotero_library_type, zotero_api_key
     )
 
-    notion_records = get_notion_records(notion_client, notion_token, notion_db_id)
-    zotero_records = get_zotero_records(zotero_client)
+    # Only records modified since the last sync need to be processed. The state is tied to the library and database
+    # it was created for, so switching either triggers a full sync.
+    sync_state = load_sync_state()
+    last_version = None
+    if (
+        sync_state.get("zotero_library_id") == zotero_library_id
+        and sync_state.get("notion_database_id") == notion_db_id
+    ):
+        last_version = sync_state.get("zotero_library_version")
+
+    # Notion records retrieved by a previous sync are cached, so only records edited since then need to be retrieved.
+    # The cache is only saved when it covers the whole database.
+    record_cache = load_record_cache(notion_db_id)
+    cached_records = record_cache["records"] if record_cache is not None else {}
+    # Notion stores edit times rounded down to the minute, so the next sync also looks at edits in the minute before.
+    synced_at = (datetime.now(timezone.utc) - timedelta(minutes=1)).isoformat()
+
+    zotero_records, library_version = get_zotero_records(
+        zotero_client, since=last_version
+    )
+    if last_version is None:
+        deleted_keys = None
+        notion_records = iter_notion_records(
+            notion_client,
+            notion_token,
+            notion_db_id,
+            edited_since=(
+                record_cache["synced_at"] if record_cache is not None else None
+            ),
+        )
+        cache_complete = True
+    else:
+        # Items moved to the trash are only reported as deleted once the trash is emptied, so they are checked as well.
+        deleted_keys = zotero_client.deleted(since=last_version)["items"]
+        deleted_keys += [
+            record["key"]
+            for record in zotero_client.everything(
+                zotero_client.trash(since=last_version)
+            )
+        ]
+        changed_keys = [record["key"] for record in zotero_records] + deleted_keys
+        notion_records = iter_notion_records(
+            notion_client, notion_token, notion_db_id, zotero_keys=changed_keys
+        )
+        # The lookup is authoritative for the changed keys, so drop cached records that no longer exist in Notion.
+        for key in changed_keys:
+            cached_records.pop(key, None)
+        cache_complete = record_cache is not None
+
+    # Get Zotero keys of records that exist in Notion. The records are streamed straight into the mapping.
+    retrieved_records = get_existing_notion_records(notion_records)
+    print(f"Retrieved {len(retrieved_records)} Notion records")
+    existing_records = {**cached_records, **retrieved_records}
+
+    # Payloads are saved if the sync fails, so a retry does not have to build them again. Once records are synced, their
+    # payloads are dropped from the cache, so it normally stays empty.
+    payload_cache = load_payload_cache()
+    loaded_payloads = {key: cached[:2] for key, cached in payload_cache.items()}
+    try:
+        existing_records = process_records(
+            zotero_records,
+            zotero_client,
+            existing_records,
+            notion_client,
+            notion_db_id,
+            deleted_keys,
+            payload_cache,
+        )
+    finally:
+        if {
+            key: cached[:2] for key, cached in payload_cache.items()
+        } != loaded_payloads:
+            save_payload_cache(payload_cache)
+    save_sync_state(
+        {
+            "zotero_library_id": zotero_library_id,
+            "notion_database_id": notion_db_id,
+            "zotero_library_version": library_version,
+        }
+    )
+    if cache_complete:
+        save_record_cache(existing_records, notion_db_id, synced_at)
+
 
-    process_records(zotero_records, zotero_client, notion_records, notion_client)
+if __name__ == "__main__":
+    main()